@@ -1,6 +1,24 @@
+import os
+
 from Cython.Build import cythonize
 from setuptools import Extension, setup
 
+# profile-guided build (build_pgo), after a normal `make`:
+#   SUNVOX_PGO=generate python3 setup.py build_ext -i --force   # instrumented
+#   make pgo-train                                              # record a profile
+#   # clang only: xcrun llvm-profdata merge -output=build/pgo/default.profdata build/pgo/*.profraw
+#   SUNVOX_PGO=use python3 setup.py build_ext -i --force        # optimised
+# `make clean` removes build/ and with it the recorded profile.
+PGO = os.environ.get('SUNVOX_PGO')
+PGO_DIR = os.path.abspath('build/pgo')
+PGO_FLAGS = {
+    'generate': [f'-fprofile-generate={PGO_DIR}'],
+    'use': [f'-fprofile-use={PGO_DIR}'],
+}
+if PGO and PGO not in PGO_FLAGS:
+    raise ValueError(f"SUNVOX_PGO must be 'generate' or 'use', not {PGO!r}")
+PGO_ARGS = PGO_FLAGS[PGO] if PGO else []
+
 setup(
     ext_modules = cythonize([
         Extension("sunvox", sources=["src/*.pyx"],
@@ -9,9 +27,17 @@ setup(
             # define_macros = [('MAJOR_VERSION', '1'),
             #                  ('MINOR_VERSION', '0')],
             include_dirs = ['./include'],
-            libraries=["sunvox"],
-            library_dirs = ['./lib'],
+            # not linked against libsunvox: sv_load_dll() dlopens it and
+            # resolves every sv_* on first use, so import stays cheap
+            extra_compile_args = ['-O3'] + PGO_ARGS,
+            extra_link_args = PGO_ARGS,
             # sources = ['demo.c'],
         )
-    ], language_level = "3")
+    ], language_level = "3",
+       compiler_directives = {
+            'boundscheck': False,
+            'wraparound': False,
+            'cdivision': True,
+            'initializedcheck': False,
+       })
 )
@@ -15,7 +15,7 @@ cdef extern from *:
     """
 
 
-cdef extern from "sunvox.h":
+cdef extern from "sunvox.h" nogil:
 
     cdef enum:
         NOTECMD_NOTE_OFF      = 128
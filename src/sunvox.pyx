@@ -1,7 +1,18 @@
-import time
+# cython: freethreading_compatible = True
+
+import atexit
+import threading
+
+from cpython cimport array
+import array
+from cython cimport view
 
 from libc.stdlib cimport malloc, free
 from libc.stdio cimport FILE, fopen, fwrite, fclose, printf
+from libc.string cimport strlen
+from libc.stdint cimport int64_t, INT64_MAX, UINT32_MAX
+from posix.time cimport clock_gettime, nanosleep, timespec, CLOCK_MONOTONIC
+from cpython.exc cimport PyErr_CheckSignals
 
 from sunvox cimport *
 
@@ -11,59 +22,523 @@ DEF NUM_CHANNELS = 2
 DEF BUFFER_SIZE = 1024
 DEF SAMPLE_TYPE = 2
 
+MODULE_FLAG_EXISTS = SV_MODULE_FLAG_EXISTS
+MODULE_FLAG_EFFECT = SV_MODULE_FLAG_EFFECT
+MODULE_FLAG_MUTE = SV_MODULE_FLAG_MUTE
+MODULE_FLAG_SOLO = SV_MODULE_FLAG_SOLO
+MODULE_FLAG_BYPASS = SV_MODULE_FLAG_BYPASS
+
+INIT_FLAG_NO_DEBUG_OUTPUT = SV_INIT_FLAG_NO_DEBUG_OUTPUT
+INIT_FLAG_USER_AUDIO_CALLBACK = SV_INIT_FLAG_USER_AUDIO_CALLBACK
+INIT_FLAG_OFFLINE = SV_INIT_FLAG_OFFLINE
+INIT_FLAG_AUDIO_INT16 = SV_INIT_FLAG_AUDIO_INT16
+INIT_FLAG_AUDIO_FLOAT32 = SV_INIT_FLAG_AUDIO_FLOAT32
+INIT_FLAG_ONE_THREAD = SV_INIT_FLAG_ONE_THREAD
+
+# read-only template for array.clone()
+cdef array.array _uint_array = array.array('I')
+
+
+class SunVoxError(Exception):
+    """raised when libsunvox cannot be set up or a song cannot be loaded"""
+
+
+cdef struct sv_config:
+    int srate
+    int nchannels
+    uint32_t flags
+
+
+# used when the first call into libsunvox does not ask for a configuration
+cdef sv_config _default_config = sv_config(SAMPLE_RATE, NUM_CHANNELS, 0)
+
+
+# libsunvox is loaded and initialised once per process and torn down at
+# exit. the (srate, nchannels, flags) of the first call are kept for the
+# whole process; asking for a different configuration raises SunVoxError.
+cdef bint _sv_dll = False
+cdef int _sv_ver = -1
+cdef int _sv_srate = 0
+cdef int _sv_nchannels = 0
+cdef uint32_t _sv_flags = 0
+_sv_lock = threading.Lock()
+
+
+cdef int _ensure_init(const sv_config* cfg) except -1:
+    # libsunvox is initialised once per process; re-initialising would free
+    # the engine under any slot another thread still has open, so a call
+    # asking for a different configuration is refused instead. a NULL cfg
+    # takes whatever is already set up, or the defaults on first use.
+    global _sv_dll, _sv_ver, _sv_srate, _sv_nchannels, _sv_flags
+    with _sv_lock:
+        if _sv_ver >= 0:
+            if cfg != NULL and (cfg.srate != _sv_srate
+                    or cfg.nchannels != _sv_nchannels or cfg.flags != _sv_flags):
+                raise SunVoxError(
+                    f"libsunvox already initialised with srate={_sv_srate}, "
+                    f"nchannels={_sv_nchannels}, flags={_sv_flags:#x}")
+            return 0
+        if not _sv_dll:
+            with nogil:
+                _sv_dll = sv_load_dll() == 0
+            if not _sv_dll:
+                raise SunVoxError("could not load libsunvox")
+        if cfg == NULL:
+            cfg = &_default_config
+        with nogil:
+            _sv_ver = sv_init(NULL, cfg.srate, cfg.nchannels, cfg.flags)
+        if _sv_ver < 0:
+            raise SunVoxError(f"could not initialise libsunvox ({_sv_ver})")
+        _sv_srate = cfg.srate
+        _sv_nchannels = cfg.nchannels
+        _sv_flags = cfg.flags
+    return 0
+
+
+def _release():
+    global _sv_dll, _sv_ver
+    with _sv_lock:
+        with nogil:
+            if _sv_ver >= 0:
+                sv_deinit()
+            if _sv_dll:
+                sv_unload_dll()
+        _sv_ver = -1
+        _sv_dll = False
+
+atexit.register(_release)
+
+
+def init(srate: int = SAMPLE_RATE, nchannels: int = NUM_CHANNELS, flags: int = 0):
+    """initialise libsunvox with the given configuration
+
+    Optional, and only useful before any other call: the first use of
+    libsunvox otherwise initialises it with 44100 Hz, 2 channels and no
+    flags, which opens the audio output. Pass
+    INIT_FLAG_OFFLINE | INIT_FLAG_ONE_THREAD for queries without an audio
+    device. Raises SunVoxError if libsunvox is already initialised with a
+    different configuration.
+    """
+    cdef sv_config cfg = sv_config(srate, nchannels, flags)
+    _ensure_init(&cfg)
+
 
 def hello():
-    sv_load_dll()
-    ver = sv_init(NULL, 44100, 2, 0)
-    if ver >= 0:
+    _ensure_init(NULL)
+    with nogil:
         sv_open_slot(0)
         sv_close_slot(0)
-        sv_deinit()
-    sv_unload_dll()
 
 
-def play(path: str, volume: int = 256, slot: int = 0, secs: int = 10):
-    sv_load_dll()
-    ver = sv_init(NULL, 44100, 2, 0)
-    if ver >= 0:
+def play(path, volume: int = 256, slot: int = 0, secs: int = 10):
+    _play(path, slot, NULL, volume, secs)
+
+
+cdef struct song_summary:
+    const char* name
+    size_t name_len
+    int bpm
+    uint32_t length_frames
+    int num_modules
+    int num_patterns
+
+
+cdef void _fill_summary(int slot, song_summary* s) noexcept nogil:
+    s.name = sv_get_song_name(slot)
+    s.name_len = strlen(s.name) if s.name != NULL else 0
+    s.bpm = sv_get_song_bpm(slot)
+    s.length_frames = sv_get_song_length_frames(slot)
+    s.num_modules = sv_get_number_of_modules(slot)
+    s.num_patterns = sv_get_number_of_patterns(slot)
+
+
+cdef struct module_snapshot:
+    const char* name
+    size_t name_len
+    uint32_t flags
+    int color
+    int x
+    int y
+    int num_ctls
+
+
+cdef void _fill_module_info(int slot, int mod_num, module_snapshot* m) noexcept nogil:
+    cdef uint32_t xy = sv_get_module_xy(slot, mod_num)
+    m.name = sv_get_module_name(slot, mod_num)
+    m.name_len = strlen(m.name) if m.name != NULL else 0
+    m.flags = sv_get_module_flags(slot, mod_num)
+    m.color = sv_get_module_color(slot, mod_num)
+    # same sign extension as SV_GET_MODULE_XY()
+    m.x = xy & 0xFFFF
+    if m.x & 0x8000:
+        m.x -= 0x10000
+    m.y = (xy >> 16) & 0xFFFF
+    if m.y & 0x8000:
+        m.y -= 0x10000
+    m.num_ctls = sv_get_number_of_module_ctls(slot, mod_num)
+
+
+cdef struct song_source:
+    char* path
+    const unsigned char* data
+    uint32_t size
+
+
+cdef object _song_source(object song, song_source* src):
+    # a str is a file path, anything else is taken as the contents of a
+    # .sunvox file and handed to libsunvox in place through the buffer
+    # protocol, viewed as raw bytes whatever its item format. the returned
+    # object keeps the path/buffer alive.
+    cdef const unsigned char[::1] buf
+    if isinstance(song, str):
+        encoded = (<str>song).encode('utf8')
+        src.path = encoded
+        src.data = NULL
+        src.size = 0
+        return encoded
+    buf = memoryview(song).cast('B')
+    if buf.shape[0] == 0:
+        raise SunVoxError("empty song data")
+    if <size_t>buf.shape[0] > UINT32_MAX:
+        raise SunVoxError(f"song data too large ({buf.shape[0]} bytes)")
+    src.path = NULL
+    src.data = &buf[0]
+    src.size = <uint32_t>buf.shape[0]
+    return buf
+
+
+cdef str _song_label(object song):
+    if isinstance(song, str):
+        return song
+    return f"<{len(memoryview(song).cast('B'))} bytes of song data>"
+
+
+cdef class _LoadedSong:
+    # returned by _load(), a context manager that closes the slot on exit
+    cdef int slot
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        with nogil:
+            sv_close_slot(self.slot)
+        return False
+
+
+cdef _LoadedSong _load(object path, int slot, const sv_config* cfg):
+    # set up libsunvox, open the slot and load the song into it. on failure
+    # the slot is closed again and SunVoxError raised, there is no separate
+    # exists() check so the path is only touched by sv_load()
+    cdef song_source src
+    cdef int loaded
+    cdef _LoadedSong song
+    # resolve the song outside the nogil block, libsunvox never calls back
+    # into python
+    _src = _song_source(path, &src)
+    _ensure_init(cfg)
+    with nogil:
         sv_open_slot(slot)
-        sv_load(slot, path.encode('utf8'))
-        sv_volume(slot, volume)
-        sv_play_from_beginning(slot)
-        time.sleep(secs)
-        sv_stop(slot)
-        sv_close_slot(slot)
-        sv_deinit()
-    sv_unload_dll()
+        if src.data != NULL:
+            loaded = sv_load_from_memory(slot, <void*>src.data, src.size)
+        else:
+            loaded = sv_load(slot, src.path)
+        if loaded != 0:
+            sv_close_slot(slot)
+    if loaded != 0:
+        raise SunVoxError(f"failed to load {_song_label(path)}")
+    song = _LoadedSong.__new__(_LoadedSong)
+    song.slot = slot
+    return song
+
+
+cdef inline int64_t _monotonic_ns() noexcept nogil:
+    cdef timespec now
+    clock_gettime(CLOCK_MONOTONIC, &now)
+    return <int64_t>now.tv_sec * 1000000000 + now.tv_nsec
+
+
+cdef int _wait_until_stopped(int slot, double timeout) except -1 nogil:
+    # poll sv_end_of_song() until the song ends or timeout secs have passed.
+    # the song only counts as ended once it has been seen playing, so a
+    # looping song (or a late start) waits out the full timeout.
+    cdef timespec tick
+    cdef int64_t now_ns
+    cdef int64_t deadline_ns
+    cdef bint started = False
+    # also catches a NaN timeout
+    if not timeout > 0:
+        return 0
+    tick.tv_sec = 0
+    tick.tv_nsec = 10000000
+    now_ns = _monotonic_ns()
+    # clamp before converting, an out of range double -> int64_t cast is
+    # undefined (on x86 it lands in the past)
+    if timeout * 1e9 >= <double>(INT64_MAX - now_ns):
+        deadline_ns = INT64_MAX
+    else:
+        deadline_ns = now_ns + <int64_t>(timeout * 1e9)
+    while True:
+        if not sv_end_of_song(slot):
+            started = True
+        elif started:
+            return 0
+        if _monotonic_ns() >= deadline_ns:
+            return 0
+        nanosleep(&tick, NULL)
+        # keep ^C working while waiting
+        with gil:
+            if PyErr_CheckSignals() != 0:
+                return -1
+
+
+cdef _play(object path, int slot, const sv_config* cfg, int volume, double secs):
+    with _load(path, slot, cfg):
+        with nogil:
+            sv_volume(slot, volume)
+            sv_play_from_beginning(slot)
+        try:
+            with nogil:
+                _wait_until_stopped(slot, secs)
+        finally:
+            with nogil:
+                sv_stop(slot)
+
+
+cdef tuple _summary(object path, int slot, const sv_config* cfg):
+    cdef song_summary s
+    with _load(path, slot, cfg):
+        with nogil:
+            _fill_summary(slot, &s)
+        # the name buffer belongs to the slot, so it is decoded straight into
+        # a str (no intermediate bytes) before the slot is closed; a
+        # memoryview over it would dangle once sv_close_slot() runs
+        name = s.name[:s.name_len].decode('utf8') if s.name_len else ''
+        return (name, s.bpm, s.length_frames, s.num_modules, s.num_patterns)
+
+
+cdef tuple _module_info(object path, int slot, const sv_config* cfg, int mod_num):
+    cdef module_snapshot m
+    cdef bint found = False
+    with _load(path, slot, cfg):
+        with nogil:
+            if (0 <= mod_num < sv_get_number_of_modules(slot)
+                    and sv_get_module_flags(slot, mod_num) & SV_MODULE_FLAG_EXISTS):
+                _fill_module_info(slot, mod_num, &m)
+                found = True
+        if not found:
+            raise SunVoxError(f"no module {mod_num} in {_song_label(path)}")
+        name = m.name[:m.name_len].decode('utf8') if m.name_len else ''
+        return (name, m.flags, m.color, m.x, m.y,
+                (m.flags & SV_MODULE_INPUTS_MASK) >> SV_MODULE_INPUTS_OFF,
+                (m.flags & SV_MODULE_OUTPUTS_MASK) >> SV_MODULE_OUTPUTS_OFF,
+                m.num_ctls)
+
+
+cdef array.array _module_flags(object path, int slot, const sv_config* cfg):
+    cdef array.array result
+    cdef int n
+    cdef int i
+    with _load(path, slot, cfg):
+        with nogil:
+            n = sv_get_number_of_modules(slot)
+        result = array.clone(_uint_array, n, zero=False)
+        with nogil:
+            for i in range(n):
+                result.data.as_uints[i] = sv_get_module_flags(slot, i)
+    return result
+
+
+cdef object _patterns(object path, int slot, const sv_config* cfg):
+    cdef int[:, ::1] table
+    cdef int n
+    cdef int k = 0
+    cdef int i, lines
+    with _load(path, slot, cfg):
+        with nogil:
+            n = sv_get_number_of_patterns(slot)
+        # view.array rejects an empty axis, the slice below trims it
+        table = view.array(shape=(max(n, 1), 5), itemsize=sizeof(int), format="i")
+        with nogil:
+            for i in range(n):
+                lines = sv_get_pattern_lines(slot, i)
+                if lines <= 0:
+                    continue
+                table[k, 0] = i
+                table[k, 1] = sv_get_pattern_tracks(slot, i)
+                table[k, 2] = lines
+                table[k, 3] = sv_get_pattern_x(slot, i)
+                table[k, 4] = sv_get_pattern_y(slot, i)
+                k += 1
+    return memoryview(table[:k])
+
+
+cdef object _pattern_events(object path, int slot, const sv_config* cfg, int pat_num):
+    cdef sunvox_note* data = NULL
+    cdef sunvox_note* n
+    cdef int[:, :, ::1] events
+    cdef int tracks = 0
+    cdef int lines = 0
+    cdef int line, track
+    with _load(path, slot, cfg):
+        with nogil:
+            if 0 <= pat_num < sv_get_number_of_patterns(slot):
+                tracks = sv_get_pattern_tracks(slot, pat_num)
+                lines = sv_get_pattern_lines(slot, pat_num)
+                data = sv_get_pattern_data(slot, pat_num)
+        if data == NULL or tracks <= 0 or lines <= 0:
+            raise SunVoxError(f"no pattern {pat_num} in {_song_label(path)}")
+        events = view.array(shape=(lines, tracks, 5), itemsize=sizeof(int), format="i")
+        with nogil:
+            for line in range(lines):
+                for track in range(tracks):
+                    n = &data[line * tracks + track]
+                    events[line, track, 0] = n.note
+                    events[line, track, 1] = n.vel
+                    events[line, track, 2] = n.module
+                    events[line, track, 3] = n.ctl
+                    events[line, track, 4] = n.ctl_val
+    return memoryview(events)
+
+
+cdef list _controllers(object path, int slot, const sv_config* cfg, int mod_num, int scaled):
+    cdef const char** names = NULL
+    cdef int* values = NULL
+    cdef int n = -1
+    cdef int i
+    with _load(path, slot, cfg):
+        with nogil:
+            if (0 <= mod_num < sv_get_number_of_modules(slot)
+                    and sv_get_module_flags(slot, mod_num) & SV_MODULE_FLAG_EXISTS):
+                n = sv_get_number_of_module_ctls(slot, mod_num)
+        if n < 0:
+            raise SunVoxError(f"no module {mod_num} in {_song_label(path)}")
+        try:
+            names = <const char**>malloc(max(n, 1) * sizeof(char*))
+            values = <int*>malloc(max(n, 1) * sizeof(int))
+            if names == NULL or values == NULL:
+                raise MemoryError()
+            with nogil:
+                for i in range(n):
+                    names[i] = sv_get_module_ctl_name(slot, mod_num, i)
+                    values[i] = sv_get_module_ctl_value(slot, mod_num, i, scaled)
+            # only building the str objects needs the GIL, and the names
+            # are owned by the slot so this happens before it is closed
+            return [((names[i].decode('utf8') if names[i] != NULL else ''), values[i])
+                    for i in range(n)]
+        finally:
+            free(names)
+            free(values)
+
+
+def summary(path, slot: int = 0):
+    """return (name, bpm, length_frames, num_modules, num_patterns) of a song
+
+    All five fields are read in one pass without the GIL. Raises
+    SunVoxError if the song could not be loaded.
+    """
+    return _summary(path, slot, NULL)
+
+
+def module_flags(path, slot: int = 0):
+    """return the flags of every module of a song as an array('I')
+
+    The flags are fetched in one C loop without the GIL; test them against
+    the MODULE_FLAG_* constants. Raises SunVoxError if the song could not
+    be loaded.
+    """
+    return _module_flags(path, slot, NULL)
+
+
+def module_info(path, mod_num: int, slot: int = 0):
+    """return (name, flags, color, x, y, num_inputs, num_outputs, num_ctls)
+
+    All fields of the module are read in one pass without the GIL. Raises
+    SunVoxError if the song could not be loaded or has no such module.
+    """
+    return _module_info(path, slot, NULL, mod_num)
+
+
+def controllers(path, mod_num: int, slot: int = 0, scaled: bool = False):
+    """return a list of (name, value) for every controller of a module
+
+    Names and values are read in one C loop without the GIL. Raises
+    SunVoxError if the song could not be loaded or has no such module.
+    """
+    return _controllers(path, slot, NULL, mod_num, scaled)
+
+
+def pattern_events(path, pat_num: int, slot: int = 0):
+    """return a (lines, tracks, 5) int memoryview of the events of a pattern
+
+    Each event is (note, vel, module, ctl, ctl_val) as stored in the
+    pattern; the whole buffer is copied in one C loop without the GIL.
+    Raises SunVoxError if the song could not be loaded or has no such
+    pattern.
+    """
+    return _pattern_events(path, slot, NULL, pat_num)
+
+
+def patterns(path, slot: int = 0):
+    """return a (n, 5) int memoryview of (num, tracks, lines, x, y) rows
+
+    One row per existing pattern, filled in one C loop without the GIL.
+    Use .tolist() or numpy.asarray() on the result. Raises SunVoxError if
+    the song could not be loaded.
+    """
+    return _patterns(path, slot, NULL)
+
 
 cdef class Patch:
-    cdef readonly str path
+    cdef readonly object path
     cdef readonly int slot
-    cdef readonly int srate
-    cdef readonly int nchannels
-    cdef readonly uint32_t flags
+    cdef sv_config cfg
 
-    def __init__(self, path: str, slot: int = 0, 
-                 srate: int = 44100, nchannels: int = 2, flags: uint32_t = 0):
+    def __init__(self, path, slot: int = 0,
+                 srate: int = SAMPLE_RATE, nchannels: int = NUM_CHANNELS,
+                 flags: uint32_t = 0):
         self.path = path
         self.slot = slot
-        self.srate = srate
-        self.nchannels = nchannels
-        self.flags = flags
+        self.cfg = sv_config(srate, nchannels, flags)
+
+    @property
+    def srate(self):
+        return self.cfg.srate
+
+    @property
+    def nchannels(self):
+        return self.cfg.nchannels
+
+    @property
+    def flags(self):
+        return self.cfg.flags
 
     def play(self, volume: int = 256, secs: int = 10):
-        sv_load_dll()
-        ver = sv_init(NULL, self.srate, self.nchannels, self.flags)
-        if ver >= 0:
-            sv_open_slot(self.slot)
-            sv_load(self.slot, self.path.encode('utf8'))
-            sv_volume(self.slot, volume)
-            sv_play_from_beginning(self.slot)
-            time.sleep(secs)
-            sv_stop(self.slot)
-            sv_close_slot(self.slot)
-            sv_deinit()
-        sv_unload_dll()
+        _play(self.path, self.slot, &self.cfg, volume, secs)
+
+    def summary(self):
+        """return (name, bpm, length_frames, num_modules, num_patterns)"""
+        return _summary(self.path, self.slot, &self.cfg)
+
+    def module_flags(self):
+        """return the flags of every module as an array('I')"""
+        return _module_flags(self.path, self.slot, &self.cfg)
+
+    def module_info(self, mod_num: int):
+        """return (name, flags, color, x, y, num_inputs, num_outputs, num_ctls)"""
+        return _module_info(self.path, self.slot, &self.cfg, mod_num)
+
+    def controllers(self, mod_num: int, scaled: bool = False):
+        """return a list of (name, value) for every controller of a module"""
+        return _controllers(self.path, self.slot, &self.cfg, mod_num, scaled)
+
+    def patterns(self):
+        """return a (n, 5) int memoryview of (num, tracks, lines, x, y) rows"""
+        return _patterns(self.path, self.slot, &self.cfg)
+
+    def pattern_events(self, pat_num: int):
+        """return a (lines, tracks, 5) int memoryview of the events of a pattern"""
+        return _pattern_events(self.path, self.slot, &self.cfg, pat_num)
 
 
 # def generate(path: str, wav_out: str):